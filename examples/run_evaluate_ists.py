@@ -8,7 +8,7 @@ import torch
 from transformers import AutoTokenizer
 
 from clrcmd.evaluation.ists import inference, load_examples, preprocess, save
-from clrcmd.models import create_contrastive_learning
+from clrcmd.models import create_contrastive_learning, load_checkpoint
 
 # fmt: off
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -39,7 +39,7 @@ def main():
         model_args = json.load(f)
     logging.info("Load model configuration")
     logging.info(f"{model_args = }")
-    tokenizer = AutoTokenizer.from_pretrained(model_args["huggingface_model_name"], use_fast=False)
+    tokenizer = AutoTokenizer.from_pretrained(model_args["huggingface_model_name"])
     logging.info(f"Loading tokenizer (model = {model_args['huggingface_model_name']})")
     examples = preprocess(tokenizer=tokenizer, examples=examples)
     logging.info("Preprocess examples (Tokenize examples)")
@@ -49,7 +49,9 @@ def main():
         model_name=model_args["model_name"], temp=model_args["temp"], dense_rwmd=False
     )
     if os.path.exists(os.path.join(args.checkpoint_dir, "pytorch_model.bin")):
-        module.load_state_dict(torch.load(os.path.join(args.checkpoint_dir, "pytorch_model.bin")))
+        module.load_state_dict(
+            load_checkpoint(os.path.join(args.checkpoint_dir, "pytorch_model.bin"))
+        )
         logging.info("Load model")
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
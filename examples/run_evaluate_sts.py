@@ -8,9 +8,15 @@ from scipy.stats import spearmanr
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from clrcmd.data.dataset import STSBenchmarkDataset
+from clrcmd.data.dataset import ContrastiveLearningCollator, STSBenchmarkDataset
 from clrcmd.data.sts import load_sts_benchmark
-from clrcmd.models import create_contrastive_learning, create_tokenizer
+from clrcmd.models import (
+    CachedSentenceRepresentationModel,
+    compile_encoder,
+    create_contrastive_learning,
+    create_tokenizer,
+    load_checkpoint,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +26,12 @@ parser.add_argument("--model", type=str, help="Model", default="bert-cls",
                     choices=["bert-cls", "bert-avg", "bert-rcmd", "roberta-cls", "roberta-avg", "roberta-rcmd"])
 parser.add_argument("--checkpoint", type=str, help="Checkpoint path", default=None)
 parser.add_argument("--data-dir", type=str, help="data dir", default="data")
+parser.add_argument("--cache-size", type=int, default=0,
+                    help="Number of cached sentence representations (0 to disable). "
+                         "Cached representations stay on the device, and rcmd models keep every token (3KB each for base models)")
+parser.add_argument("--quantize", action="store_true", help="Apply int8 dynamic quantization (cpu only)")
+parser.add_argument("--bf16", action="store_true", help="Run encoder with bfloat16 autocast")
+parser.add_argument("--torch-compile", action="store_true", help="Compile encoder (torch>=2.0)")
 # fmt: on
 
 
@@ -45,14 +57,41 @@ def main():
 
     # Load method
     if args.checkpoint is not None:
-        model.load_state_dict(torch.load(os.path.join(args.checkpoint, "pytorch_model.bin")))
+        model.load_state_dict(load_checkpoint(os.path.join(args.checkpoint, "pytorch_model.bin")))
     model = model.model
+    if args.quantize:
+        if device.type != "cpu":
+            raise ValueError(f"Dynamic quantization is not supported on {device = }")
+        if args.bf16:
+            raise ValueError(
+                "Dynamic quantization only takes float32 input, so it can't run with bf16"
+            )
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if args.torch_compile:
+        compile_encoder(model)
+    if args.cache_size > 0:
+        model.representation_model = CachedSentenceRepresentationModel(
+            model.representation_model, max_size=args.cache_size
+        )
 
     # Load dataset
     sources = load_sts_benchmark(args.data_dir)
+    # Sort examples by length so that each batch carries less padding
+    sources = {
+        name: {
+            k: sorted(v, key=lambda x: max(len(x[0][0].split()), len(x[0][1].split())))
+            for k, v in testset.items()
+        }
+        for name, testset in sources.items()
+    }
     loaders = {
         name: {
-            k: DataLoader(STSBenchmarkDataset(v, tokenizer), batch_size=32)
+            k: DataLoader(
+                STSBenchmarkDataset(v, tokenizer),
+                batch_size=32,
+                collate_fn=ContrastiveLearningCollator(),
+                pin_memory=device.type == "cuda",
+            )
             for k, v in testset.items()
         }
         for name, testset in sources.items()
@@ -61,16 +100,21 @@ def main():
     # Evaluate
     result = {}
     model.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
         for source_name, source in loaders.items():
             logger.info(f"Evaluate {source_name}")
             scores_all, labels_all = [], []
             for _, loader in source.items():
                 scores, labels = [], []
                 for examples in tqdm(loader, desc=f"Evaluate {source_name}"):
-                    inputs1 = {k: v.to(device) for k, v in examples["inputs1"].items()}
-                    inputs2 = {k: v.to(device) for k, v in examples["inputs2"].items()}
-                    scores.append(model(inputs1, inputs2).cpu().numpy())
+                    inputs1, inputs2 = examples["inputs1"], examples["inputs2"]
+                    if args.cache_size == 0:
+                        # Otherwise the cache copies only the sentences which are not cached
+                        inputs1 = {k: v.to(device, non_blocking=True) for k, v in inputs1.items()}
+                        inputs2 = {k: v.to(device, non_blocking=True) for k, v in inputs2.items()}
+                    with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16):
+                        score = model(inputs1, inputs2)
+                    scores.append(score.float().cpu().numpy())
                     labels.append(examples["label"].numpy())
                 scores, labels = np.concatenate(scores), np.concatenate(labels)
                 scores_all.append(scores)
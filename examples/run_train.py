@@ -11,7 +11,7 @@ from clrcmd.data.dataset import (
     STSBenchmarkDataset,
 )
 from clrcmd.data.sts import load_stsb_dev
-from clrcmd.models import create_contrastive_learning, create_tokenizer
+from clrcmd.models import compile_encoder, create_contrastive_learning, create_tokenizer
 from clrcmd.trainer import STSTrainer, compute_metrics
 
 logger = logging.getLogger(__name__)
@@ -24,6 +24,9 @@ parser.add_argument("--model", type=str, help="Model", default="bert-cls",
 parser.add_argument("--output-dir", type=str, help="Output directory", default="ckpt")
 parser.add_argument("--temp", type=float, help="Softmax temperature", default=0.05)
 parser.add_argument("--seed", type=int, help="Seed", default=0)
+parser.add_argument("--gradient-checkpointing", action="store_true", help="Use gradient checkpointing for encoder")
+parser.add_argument("--torch-compile", action="store_true", help="Compile encoder (torch>=2.0)")
+parser.add_argument("--cache-dataset", action="store_true", help="Save tokenized training set in data directory to reuse it")
 # fmt: on
 
 
@@ -48,6 +51,9 @@ def main():
         greater_is_better=True,
         save_total_limit=1,
         seed=args.seed,
+        # Every parameter is used once the pooling layer is dropped. Searching for unused
+        # parameters also breaks DDP with reentrant gradient checkpointing
+        ddp_find_unused_parameters=False if args.gradient_checkpointing else None,
     )
     if training_args.local_rank == -1 or training_args.local_rank == 0:
         logging.basicConfig(
@@ -73,12 +79,20 @@ def main():
 
     # Load pretrained model and tokenizer
     tokenizer = create_tokenizer(args.model)
-    model = create_contrastive_learning(args.model, args.temp)
+    model = create_contrastive_learning(
+        args.model, args.temp, gradient_checkpointing=args.gradient_checkpointing
+    )
+    if args.torch_compile:
+        compile_encoder(model.model)
     model.train()
 
-    train_dataset = NLIContrastiveLearningDataset(
-        os.path.join(args.data_dir, "nli_for_simcse.csv"), tokenizer
-    )
+    # Let the main process tokenize and cache the dataset before the others load it
+    with training_args.main_process_first(desc="NLI dataset tokenization"):
+        train_dataset = NLIContrastiveLearningDataset(
+            os.path.join(args.data_dir, "nli_for_simcse.csv"),
+            tokenizer,
+            cache_dir=args.data_dir if args.cache_dataset else None,
+        )
     eval_dataset = STSBenchmarkDataset(
         load_stsb_dev(os.path.join(args.data_dir, "STS", "STSBenchmark"))["dev"], tokenizer
     )
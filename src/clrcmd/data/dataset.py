@@ -1,6 +1,8 @@
 import csv
+import glob
 import logging
-from typing import Dict, List, Tuple
+import os
+from typing import Dict, List, Optional, Tuple
 
 import torch
 from torch import Tensor
@@ -34,33 +36,84 @@ class STSBenchmarkDataset(Dataset):
 
 
 class NLIContrastiveLearningDataset(Dataset):
-    def __init__(self, filepath: str, tokenizer: PreTrainedTokenizerBase):
-        with open(filepath) as f:
-            self.examples = [
-                (row["sent0"], row["sent1"], row["hard_neg"]) for row in csv.DictReader(f)
-            ]
+    def __init__(
+        self,
+        filepath: str,
+        tokenizer: PreTrainedTokenizerBase,
+        max_length: int = 32,
+        cache_dir: Optional[str] = None,
+    ):
+        """Dataset which tokenizes the whole NLI triplets in advance
+
+        :param filepath: Filepath of csv file which has sent0, sent1, and hard_neg columns
+        :param tokenizer: Tokenizer
+        :param max_length: Maximum number of tokens of each sentence
+        :param cache_dir: Directory where the tokenized dataset is saved. If the dataset is
+                          already saved for the same file, tokenizer, and max_length, it is
+                          loaded instead of tokenizing the dataset again
+        """
         self.tokenizer = tokenizer
+        self.max_length = max_length
+        if cache_dir is None:
+            self.examples = self.tokenize(filepath)
+            return
+        cache_filepath = os.path.join(cache_dir, self.cache_filename(filepath))
+        if os.path.exists(cache_filepath):
+            self.examples = torch.load(cache_filepath)
+            logger.info(f"Load tokenized dataset from {cache_filepath}")
+        else:
+            self.examples = self.tokenize(filepath)
+            # Remove the caches of the previous versions of the file
+            prefix = self.cache_filename(filepath).rsplit(".", 3)[0]
+            pattern = os.path.join(glob.escape(cache_dir), f"{glob.escape(prefix)}.*.*.pt")
+            for x in glob.glob(pattern):
+                os.remove(x)
+                logger.info(f"Remove stale tokenized dataset {x}")
+            # Save to a temporary file first so that other processes never read a partial file
+            tmp_filepath = f"{cache_filepath}.{os.getpid()}.tmp"
+            torch.save(self.examples, tmp_filepath)
+            os.replace(tmp_filepath, cache_filepath)
+            logger.info(f"Save tokenized dataset to {cache_filepath}")
+
+    def cache_filename(self, filepath: str) -> str:
+        stat = os.stat(filepath)
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        tokenizer_name = self.tokenizer.name_or_path.replace("/", "_")
+        return f"{name}.{tokenizer_name}.{self.max_length}.{stat.st_mtime_ns}.{stat.st_size}.pt"
+
+    def tokenize(self, filepath: str) -> Dict[str, Dict[str, Tensor]]:
+        with open(filepath) as f:
+            rows = [(row["sent0"], row["sent1"], row["hard_neg"]) for row in csv.DictReader(f)]
+        # Store the tokenized dataset with the smallest dtypes, which are cast back to int64
+        # when the examples are accessed
+        if len(self.tokenizer) <= torch.iinfo(torch.int16).max + 1:
+            ids_dtype = torch.int16
+        else:
+            ids_dtype = torch.int32
+        examples = {}
+        for i, k in enumerate(("inputs1", "inputs2", "inputs_neg")):
+            x = self.tokenizer(
+                [row[i] for row in rows],
+                truncation=True,
+                padding="max_length",
+                max_length=self.max_length,
+                return_tensors="pt",
+            )
+            examples[k] = {
+                name: v.to(ids_dtype if name == "input_ids" else torch.uint8)
+                for name, v in x.items()
+            }
+        return examples
 
     def __getitem__(
         self, idx: int
     ) -> Tuple[Dict[str, Tensor], Dict[str, Tensor], Dict[str, Tensor]]:
-        text1, text2, text_neg = self.examples[idx]
-        text1 = self.tokenizer(
-            text1, truncation=True, padding="max_length", max_length=32, return_tensors="pt"
-        )
-        text2 = self.tokenizer(
-            text2, truncation=True, padding="max_length", max_length=32, return_tensors="pt"
-        )
-        text_neg = self.tokenizer(
-            text_neg, truncation=True, padding="max_length", max_length=32, return_tensors="pt"
-        )
-        text1 = {k: v[0] for k, v in text1.items()}
-        text2 = {k: v[0] for k, v in text2.items()}
-        text_neg = {k: v[0] for k, v in text_neg.items()}
-        return {"inputs1": text1, "inputs2": text2, "inputs_neg": text_neg}
+        return {
+            k: {name: v[idx].long() for name, v in x.items()} for k, x in self.examples.items()
+        }
 
     def __len__(self) -> int:
-        return len(self.examples)
+        return len(self.examples["inputs1"]["input_ids"])
 
 
 class ContrastiveLearningCollator:
@@ -77,4 +130,9 @@ class ContrastiveLearningCollator:
                 result["inputs_neg"] = default_data_collator([x["inputs_neg"] for x in features])
             elif k == "label":
                 result["label"] = torch.stack([x["label"] for x in features])
+        # Trim the padding which is shared by every sentence in the batch
+        keys = [k for k in ("inputs1", "inputs2", "inputs_neg") if k in result]
+        seq_len = max(result[k]["attention_mask"].sum(dim=1).max().item() for k in keys)
+        for k in keys:
+            result[k] = {name: v[:, :seq_len] for name, v in result[k].items()}
         return result
@@ -1,3 +1,4 @@
+import itertools
 import logging
 import re
 from typing import List, Optional, Tuple, TypedDict
@@ -6,7 +7,7 @@ import numpy as np
 import torch
 from bs4 import BeautifulSoup
 from tokenizations import get_alignments
-from transformers import PreTrainedTokenizerBase
+from transformers import BatchEncoding, PreTrainedTokenizerBase
 
 from clrcmd.models import ModelInput, SentenceSimilarityModel
 
@@ -138,20 +139,21 @@ class PreprocessedExample(TypedDict):
 def preprocess(
     tokenizer: PreTrainedTokenizerBase, examples: List[Example]
 ) -> List[PreprocessedExample]:
-    def tokenize(s: str):
-        return tokenizer.convert_ids_to_tokens(tokenizer(s, add_special_tokens=False)["input_ids"])
+    # Tokenize the whole sentences at once
+    sent1, sent2 = [x["sent1"] for x in examples], [x["sent2"] for x in examples]
+    sent1_ids = tokenizer(sent1, add_special_tokens=False)["input_ids"]
+    sent2_ids = tokenizer(sent2, add_special_tokens=False)["input_ids"]
+    batch1, batch2 = tokenizer(sent1), tokenizer(sent2)
 
     prep_examples = []
-    for example in examples:
-        sent1_token = tokenize(example["sent1"])
-        sent2_token = tokenize(example["sent2"])
-        inputs1 = tokenizer(example["sent1"], return_tensors="pt")
-        inputs2 = tokenizer(example["sent2"], return_tensors="pt")
+    for i, example in enumerate(examples):
+        inputs1 = BatchEncoding({k: [v[i]] for k, v in batch1.items()}, tensor_type="pt")
+        inputs2 = BatchEncoding({k: [v[i]] for k, v in batch2.items()}, tensor_type="pt")
         prep_examples.append(
             {
                 "example": example,
-                "sent1_token": sent1_token,
-                "sent2_token": sent2_token,
+                "sent1_token": tokenizer.convert_ids_to_tokens(sent1_ids[i]),
+                "sent2_token": tokenizer.convert_ids_to_tokens(sent2_ids[i]),
                 "inputs1": inputs1,
                 "inputs2": inputs2,
             }
@@ -175,7 +177,7 @@ def inference(
     model.eval()
     infered_examples = []
     for prep_example in prep_examples:
-        logger.debug(f"{prep_example}")
+        logger.debug("%s", prep_example)
         # Compute heatmap
         with torch.no_grad():
             inputs1 = prep_example["inputs1"].to(device)
@@ -188,8 +190,8 @@ def inference(
         align_sent2_token2chunk = get_alignments(
             prep_example["sent2_token"], prep_example["example"]["sent2_chunk"]
         )
-        logger.debug(f"{align_sent1_token2chunk}")
-        logger.debug(f"{align_sent2_token2chunk}")
+        logger.debug("%s", align_sent1_token2chunk)
+        logger.debug("%s", align_sent2_token2chunk)
         heatmap_chunk = pool_heatmap(
             heatmap_token, align_sent1_token2chunk, align_sent2_token2chunk
         )
@@ -252,15 +254,16 @@ def pool_heatmap(
     align_sent1: Tuple[List[List[int]], List[List[int]]],
     align_sent2: Tuple[List[List[int]], List[List[int]]],
 ) -> np.ndarray:
-    sent1_chunk_len, sent2_chunk_len = len(align_sent1[1]), len(align_sent2[1])
-    # Split heatmap blockwise
-
-    heatmap_splitted = [[heatmap[np.ix_(x, y)] for y in align_sent2[1]] for x in align_sent1[1]]
-    heatmap_pooled1 = np.zeros((sent1_chunk_len, sent2_chunk_len))
-    heatmap_pooled2 = np.zeros((sent1_chunk_len, sent2_chunk_len))
-    for i, x in enumerate(heatmap_splitted):
-        for j, y in enumerate(x):
-            heatmap_pooled1[i, j] = np.mean(np.mean(y, axis=1))
-            heatmap_pooled2[i, j] = np.mean(np.mean(y, axis=0))
-    heatmap_pooled = (heatmap_pooled1 + heatmap_pooled2) / 2
-    return heatmap_pooled
+    # Average the heatmap blockwise, which is computed as P1 @ heatmap @ P2.T
+    # where P is the row-normalized assignment matrix from chunks to tokens
+    pooling1 = create_pooling_matrix(align_sent1[1], heatmap.shape[0])
+    pooling2 = create_pooling_matrix(align_sent2[1], heatmap.shape[1])
+    return pooling1 @ heatmap @ pooling2.T
+
+
+def create_pooling_matrix(chunk2token: List[List[int]], num_tokens: int) -> np.ndarray:
+    rows = np.repeat(np.arange(len(chunk2token)), list(map(len, chunk2token)))
+    cols = np.fromiter(itertools.chain.from_iterable(chunk2token), dtype=int)
+    matrix = np.zeros((len(chunk2token), num_tokens))
+    matrix[rows, cols] = 1
+    return matrix / np.sum(matrix, axis=1, keepdims=True)
@@ -1,11 +1,15 @@
+import hashlib
+import inspect
 import logging
-from typing import Dict, Optional, Tuple
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
 
 import torch
 import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
+from torch.nn.utils.rnn import pad_sequence
 from transformers import (
     AutoModel,
     AutoTokenizer,
@@ -13,7 +17,7 @@ from transformers import (
     PreTrainedTokenizerBase,
 )
 
-from clrcmd.utils import masked_mean
+from clrcmd.utils import masked_average_pool, masked_mean
 
 logger = logging.getLogger(__name__)
 
@@ -31,22 +35,25 @@ def dist_all_gather(x: Tensor) -> Tensor:
     """
     assert dist.is_initialized(), "The process is not in DDP setting"
     world_size = dist.get_world_size()
-    # 1. Get size acroess processes
-    x_numel_list = [torch.tensor(x.numel(), device=x.device) for _ in range(world_size)]
-    dist.all_gather(x_numel_list, torch.tensor(x.numel(), device=x.device))
+    # NOTE: `all_gather_into_tensor` is called `_all_gather_base` before torch 1.13
+    all_gather_into_tensor = getattr(dist, "all_gather_into_tensor", None)
+    if all_gather_into_tensor is None:
+        all_gather_into_tensor = dist._all_gather_base
+    # 1. Get size across processes
+    size = torch.tensor([x.shape[0]], device=x.device)
+    size_list = torch.empty((world_size,), dtype=size.dtype, device=x.device)
+    all_gather_into_tensor(size_list, size)
+    size_list = size_list.tolist()
     # 2. Infer maximum size
-    max_size = max(x.item() for x in x_numel_list)
-    # 3. Communitcate tensor with padded version
-    _x_list = [torch.empty((max_size,), device=x.device) for _ in range(world_size)]
-    _x = torch.cat(
-        (
-            x.contiguous().view(-1),
-            torch.empty((max_size - x.numel(),), device=x.device),
-        )
-    )
-    dist.all_gather(_x_list, _x)
+    max_size = max(size_list)
+    # 3. Communicate tensor with padded version into a single contiguous buffer
+    padding = torch.zeros((max_size - x.shape[0], *x.shape[1:]), dtype=x.dtype, device=x.device)
+    _x = torch.cat((x.detach(), padding))
+    out = torch.empty((world_size * max_size, *x.shape[1:]), dtype=x.dtype, device=x.device)
+    all_gather_into_tensor(out, _x.contiguous())
     # 4. Remove padded data to change original shape
-    x_list = [_x[:n].view(-1, *x.shape[1:]) for n, _x in zip(x_numel_list, _x_list)]
+    out = out.view(world_size, max_size, *x.shape[1:])
+    x_list = [out[i, :n] for i, n in enumerate(size_list)]
     # Since `all_gather` results do not have gradients, we replace the
     # current process's corresponding embeddings with original tensors
     x_list[dist.get_rank()] = x
@@ -56,6 +63,18 @@ def dist_all_gather(x: Tensor) -> Tensor:
 ModelInput = Dict[str, Tensor]
 
 
+def split_representation(x: Union[Tensor, Tuple[Tensor, Tensor]], sections: Tuple[int, ...]):
+    """Split the representation of concatenated inputs into sections
+
+    :param x: Representation, either a tensor or a tuple of (hidden, mask)
+    :param sections: Batch size of each section
+    :return: List of representations, one for each section
+    """
+    if isinstance(x, Tensor):
+        return torch.split(x, sections)
+    return list(zip(torch.split(x[0], sections), torch.split(x[1], sections)))
+
+
 class LastHiddenSentenceRepresentationModel(nn.Module):
     def __init__(self, model: PreTrainedModel, head: bool = False):
         super().__init__()
@@ -105,8 +124,9 @@ class AveragePoolingSentenceRepresentationModel(nn.Module):
             self.linear = nn.Linear(hidden_size, hidden_size)
 
     def forward(self, inputs: ModelInput) -> Tensor:
-        mask = inputs["attention_mask"].bool().unsqueeze(2)
-        outputs = masked_mean(self.model(**inputs).last_hidden_state, mask, dim=1)
+        outputs = masked_average_pool(
+            self.model(**inputs).last_hidden_state, inputs["attention_mask"]
+        )
         if self.head:
             outputs = self.linear(outputs)
         return outputs
@@ -118,6 +138,71 @@ class AveragePoolingSentenceRepresentationModel(nn.Module):
         return outputs, inputs["attention_mask"].bool()
 
 
+class CachedSentenceRepresentationModel(nn.Module):
+    def __init__(self, model: nn.Module, max_size: int = 10000):
+        """Reuse the representation of sentences that are already encoded
+
+        Sentences are identified by their unpadded input ids, so it is only valid
+        when the parameters are fixed (i.e. inference). Inputs may be kept on cpu,
+        then only the sentences which are not cached are copied to the model device
+
+        :param model: Sentence representation model
+        :param max_size: Maximum number of cached sentences. Least recently used
+                         sentences are evicted first
+        """
+        super().__init__()
+        self.model = model
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+    def forward(self, inputs: ModelInput) -> Union[Tensor, Tuple[Tensor, Tensor]]:
+        device = next(self.model.parameters()).device
+        input_ids, mask = inputs["input_ids"].cpu().numpy(), inputs["attention_mask"].cpu().numpy()
+        keys = [
+            hashlib.blake2b(x[m.astype(bool)].tobytes(), digest_size=16).digest()
+            for x, m in zip(input_ids, mask)
+        ]
+        rows = {}
+        for key in keys:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                rows[key] = self.cache[key]
+        # Encode sentences which are not cached, once for each distinct sentence
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in rows and key not in missing:
+                missing[key] = i
+        if len(missing) > 0:
+            indice = torch.tensor(list(missing.values()), device=inputs["input_ids"].device)
+            outputs = self.model(
+                {k: v[indice].to(device, non_blocking=True) for k, v in inputs.items()}
+            )
+            if isinstance(outputs, Tensor):
+                # Copy each row so that it does not keep the whole batch output alive
+                outputs = [x.clone() for x in outputs.unbind(0)]
+            else:
+                # Strip the padding so that the row does not depend on the batch
+                outputs = [x[m] for x, m in zip(outputs[0], outputs[1])]
+            for key, x in zip(missing, outputs):
+                rows[key] = x
+                self.cache[key] = x
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        rows = [rows[key] for key in keys]
+        if rows[0].dim() == 1:
+            return torch.stack(rows)
+        # Pad the token representation back to the input length
+        seq_len = mask.shape[1]
+        hidden = pad_sequence(rows, batch_first=True)
+        hidden = F.pad(hidden, (0, 0, 0, seq_len - hidden.shape[1]))
+        lengths = torch.tensor([x.shape[0] for x in rows], device=device)
+        mask = torch.arange(seq_len, device=device) < lengths[:, None]
+        return hidden, mask
+
+    def compute_last_hidden(self, inputs: ModelInput) -> Tuple[Tensor, Tensor]:
+        return self.model.compute_last_hidden(inputs)
+
+
 class SentenceBertLearningModule(nn.Module):
     def __init__(self, model: nn.Module, hidden_size: int):
         super().__init__()
@@ -144,7 +229,14 @@ class SentenceSimilarityModel(nn.Module):
         :param inputs2: model input for sentence2.
         :return: similarity score.
         """
-        x1, x2 = self.representation_model(inputs1), self.representation_model(inputs2)
+        if inputs1["input_ids"].shape[1:] == inputs2["input_ids"].shape[1:]:
+            # Encode both sentences in a single forward pass
+            inputs = {k: torch.cat((inputs1[k], inputs2[k]), dim=0) for k in inputs1.keys()}
+            sections = inputs1["input_ids"].shape[0], inputs2["input_ids"].shape[0]
+            x1, x2 = split_representation(self.representation_model(inputs), sections)
+        else:
+            x1 = self.representation_model(inputs1)
+            x2 = self.representation_model(inputs2)
         return self.similarity(x1, x2)
 
     def compute_heatmap(self, inputs1: ModelInput, inputs2: ModelInput) -> Tensor:
@@ -167,27 +259,13 @@ class SimcseLearningModule(nn.Module):
         inputs2: ModelInput,
         inputs_neg: Optional[ModelInput] = None,
     ) -> Tuple[Tensor]:
-        if inputs_neg is not None:
-            inputs = {
-                k: torch.cat((inputs1[k], inputs2[k], inputs_neg[k]), dim=0)
-                for k in inputs1.keys()
-            }
-        else:
-            inputs = {k: torch.cat((inputs1[k], inputs2[k]), dim=0) for k in inputs1.keys()}
+        inputs_list = [inputs1, inputs2] if inputs_neg is None else [inputs1, inputs2, inputs_neg]
+        inputs = {k: torch.cat([x[k] for x in inputs_list], dim=0) for k in inputs1.keys()}
         x = self.model.representation_model(inputs)
-        if inputs_neg is not None:
-            sections = (
-                inputs1["input_ids"].shape[0],
-                inputs2["input_ids"].shape[0] + inputs_neg["input_ids"].shape[0],
-            )
-        else:
-            sections = inputs1["input_ids"].shape[0], inputs2["input_ids"].shape[0]
-
-        # NOTE: Really bad.. how to fix it?
-        if type(x) == Tensor:
-            x1, x2 = torch.split(x, sections)
-        else:
-            x1, x2 = list(zip(torch.split(x[0], sections), torch.split(x[1], sections)))
+        # Positives and hard negatives are compared against the anchors together
+        batch_size = inputs1["input_ids"].shape[0]
+        sections = batch_size, inputs["input_ids"].shape[0] - batch_size
+        x1, x2 = split_representation(x, sections)
         sim = self.pairwise_similarity(x1, x2)
         sim = sim / self.temp
         # (batch_size, batch_size)
@@ -198,11 +276,21 @@ class SimcseLearningModule(nn.Module):
 def compute_alignment(
     x1: Tensor, x2: Tensor, mask1: Tensor, mask2: Tensor
 ) -> Tuple[Tensor, Tensor]:
-    sim = F.cosine_similarity(x1.unsqueeze(-2), x2.unsqueeze(-3), dim=-1)
+    """Compute the most similar token of the other sentence for every pair of sentences
+
+    :param x1: (batch1, seq_len1, hidden_dim), torch.float
+    :param x2: (batch2, seq_len2, hidden_dim), torch.float
+    :param mask1: (batch1, seq_len1), torch.bool
+    :param mask2: (batch2, seq_len2), torch.bool
+    :return: (batch1, batch2, seq_len1), (batch1, batch2, seq_len2), torch.long
+    """
+    x1, x2 = F.normalize(x1, dim=-1), F.normalize(x2, dim=-1)
+    # Token similarity of every sentence pair in a single GEMM
+    sim = torch.einsum("bih,cjh->bcij", x1, x2)
+    # (batch1, batch2, seq_len1, seq_len2)
     # Set similarity of invalid position to negative inf
-    inf = torch.tensor(float("-inf"), device=sim.device)
-    sim = torch.where(mask1.unsqueeze(-1), sim, inf)
-    sim = torch.where(mask2.unsqueeze(-2), sim, inf)
+    sim = sim.masked_fill(~mask1[:, None, :, None], float("-inf"))
+    sim = sim.masked_fill(~mask2[None, :, None, :], float("-inf"))
     indice1 = torch.max(sim, dim=-1)[1]
     indice2 = torch.max(sim, dim=-2)[1]
     return indice1, indice2
@@ -222,9 +310,8 @@ class RelaxedWordMoverSimilarity(nn.Module):
         """
         (x1, mask1), (x2, mask2) = x1, x2
         sim = self.cos(x1[:, :, None, :], x2[:, None, :, :])
-        inf = torch.tensor(float("-inf"), device=sim.device)
-        sim = torch.where(mask1.unsqueeze(-1), sim, inf)
-        sim = torch.where(mask2.unsqueeze(-2), sim, inf)
+        sim = sim.masked_fill(~mask1.unsqueeze(-1), float("-inf"))
+        sim = sim.masked_fill(~mask2.unsqueeze(-2), float("-inf"))
         # (batch, seq_len1, seq_len2)
         sim1, sim2 = torch.max(sim, dim=2)[0], torch.max(sim, dim=1)[0]
         sim1 = masked_mean(sim1, mask1, dim=1)
@@ -235,9 +322,8 @@ class RelaxedWordMoverSimilarity(nn.Module):
     def compute_heatmap(self, x1: Tuple[Tensor, Tensor], x2: Tuple[Tensor, Tensor]) -> Tensor:
         (x1, mask1), (x2, mask2) = x1, x2
         sim = self.cos(x1[:, :, None, :], x2[:, None, :, :])
-        inf = torch.tensor(float("-inf"), device=sim.device)
-        sim = torch.where(mask1.unsqueeze(-1), sim, inf)
-        sim = torch.where(mask2.unsqueeze(-2), sim, inf)
+        sim = sim.masked_fill(~mask1.unsqueeze(-1), float("-inf"))
+        sim = sim.masked_fill(~mask2.unsqueeze(-2), float("-inf"))
         # (batch, seq_len1, seq_len2)
         sim1 = torch.mul(sim, (sim == torch.max(sim, dim=2, keepdim=True)[0]).float())
         sim2 = torch.mul(sim, (sim == torch.max(sim, dim=1, keepdim=True)[0]).float())
@@ -260,22 +346,11 @@ class PairwiseRelaxedWordMoverSimilarity(nn.Module):
         :return: (batch1, batch2)
         """
         (x1, mask1), (x2, mask2) = x1, x2
-        batch1, seq_len1, hidden_dim = x1.shape
-        batch2, seq_len2, _ = x2.shape
-        # Compute max indice batchwise
+        batch1, _, hidden_dim = x1.shape
+        batch2, _, _ = x2.shape
+        # Compute max indice
         with torch.no_grad():
-            indice1 = torch.empty((batch1, batch2, seq_len1), dtype=torch.long, device=x1.device)
-            indice2 = torch.empty((batch1, batch2, seq_len2), dtype=torch.long, device=x2.device)
-            for i in range(0, batch1, 8):
-                for j in range(0, batch2, 8):
-                    _indice1, _indice2 = compute_alignment(
-                        x1[i : i + 8, None, :, :],
-                        x2[None, j : j + 8, :, :],
-                        mask1[i : i + 8, None, :],
-                        mask2[None, j : j + 8, :],
-                    )
-                    indice1[i : i + 8, j : j + 8, :] = _indice1
-                    indice2[i : i + 8, j : j + 8, :] = _indice2
+            indice1, indice2 = compute_alignment(x1, x2, mask1, mask2)
         # Construct computational graph for RWMD
         x1, x2 = x1.unsqueeze(1), x2.unsqueeze(0)
         sim1 = self.cos(
@@ -317,9 +392,8 @@ class DensePairwiseRelaxedWordMoverSimilarity(nn.Module):
         (x1, mask1), (x2, mask2) = x1, x2
         sim = self.cos(x1[:, None, :, None, :], x2[None, :, None, :, :])
         # (batch1, batch2, seq_len1, seq_len2)
-        inf = torch.tensor(float("-inf"), device=sim.device)
-        sim = torch.where(mask1[:, None, :, None], sim, inf)
-        sim = torch.where(mask2[None, :, None, :], sim, inf)
+        sim = sim.masked_fill(~mask1[:, None, :, None], float("-inf"))
+        sim = sim.masked_fill(~mask2[None, :, None, :], float("-inf"))
         sim1, sim2 = torch.max(sim, dim=3)[0], torch.max(sim, dim=2)[0]
         # (batch1, batch2, seq_len1), (batch1, batch2, seq_len2)
         sim1 = masked_mean(sim1, mask1[:, None, :], dim=-1)
@@ -338,12 +412,11 @@ class CosineSimilarity(nn.Module):
 
     def compute_heatmap(self, x1: Tuple[Tensor, Tensor], x2: Tuple[Tensor, Tensor]) -> Tensor:
         (x1, mask1), (x2, mask2) = x1, x2
-        s1 = masked_mean(x1, mask1.unsqueeze(2), dim=1)  # (batch, hidden)
-        s2 = masked_mean(x2, mask2.unsqueeze(2), dim=1)  # (batch, hidden)
+        s1 = masked_average_pool(x1, mask1)  # (batch, hidden)
+        s2 = masked_average_pool(x2, mask2)  # (batch, hidden)
         sim = torch.einsum("bih,bjh->bij", x1, x2)
-        inf = torch.tensor(float("-inf"), device=sim.device)
-        sim = torch.where(mask1.unsqueeze(-1), sim, inf)
-        sim = torch.where(mask2.unsqueeze(-2), sim, inf)
+        sim = sim.masked_fill(~mask1.unsqueeze(-1), float("-inf"))
+        sim = sim.masked_fill(~mask2.unsqueeze(-2), float("-inf"))
         sim = sim / torch.norm(s1, dim=1)[:, None, None]
         sim = sim / torch.norm(s2, dim=1)[:, None, None]
         sim = sim / torch.count_nonzero(mask1, dim=1)[:, None, None]
@@ -353,25 +426,41 @@ class CosineSimilarity(nn.Module):
 
 class PairwiseCosineSimilarity(nn.Module):
     def forward(self, x1: Tensor, x2: Tensor) -> Tensor:
-        return F.cosine_similarity(x1.unsqueeze(1), x2.unsqueeze(0), dim=-1)
+        # Normalize first so that the pairwise similarity becomes a single matmul
+        # instead of a (batch1, batch2, hidden_dim) broadcast. Compute it in float32 as
+        # F.cosine_similarity does under autocast, since the logits are divided by temperature
+        x1, x2 = F.normalize(x1.float(), dim=-1), F.normalize(x2.float(), dim=-1)
+        with torch.autocast(x1.device.type, enabled=False):
+            return torch.matmul(x1, x2.T)
 
 
 def create_tokenizer(model_name: str) -> PreTrainedTokenizerBase:
     if model_name.startswith("bert"):
-        return AutoTokenizer.from_pretrained("bert-base-uncased", use_fast=False)
+        return AutoTokenizer.from_pretrained("bert-base-uncased")
     elif model_name.startswith("roberta"):
-        return AutoTokenizer.from_pretrained("roberta-base", use_fast=False)
+        return AutoTokenizer.from_pretrained("roberta-base")
     else:
         raise ValueError(f"Undefined {model_name = }")
 
 
-def create_similarity_model(model_name: str) -> nn.Module:
+def create_similarity_model(model_name: str, gradient_checkpointing: bool = False) -> nn.Module:
     if model_name.startswith("bert"):
-        model = AutoModel.from_pretrained("bert-base-uncased")
+        model = AutoModel.from_pretrained("bert-base-uncased", add_pooling_layer=False)
     elif model_name.startswith("roberta"):
-        model = AutoModel.from_pretrained("roberta-base")
+        model = AutoModel.from_pretrained("roberta-base", add_pooling_layer=False)
     else:
         raise ValueError(f"Undefined {model_name = }")
+    if gradient_checkpointing:
+        if hasattr(model, "gradient_checkpointing_enable"):
+            # Non-reentrant checkpointing works with DDP and torch.compile (transformers>=4.35)
+            kwargs = {}
+            parameters = inspect.signature(model.gradient_checkpointing_enable).parameters
+            if "gradient_checkpointing_kwargs" in parameters:
+                kwargs["gradient_checkpointing_kwargs"] = {"use_reentrant": False}
+            model.gradient_checkpointing_enable(**kwargs)
+        else:
+            # transformers<4.11 reads the flag from the config
+            model.config.gradient_checkpointing = True
     if model_name.endswith("cls"):
         model = CLSPoolingSentenceRepresentationModel(model, head=True)
         model = SentenceSimilarityModel(model, CosineSimilarity(dim=-1))
@@ -386,10 +475,43 @@ def create_similarity_model(model_name: str) -> nn.Module:
     return model
 
 
+def load_checkpoint(filepath: str) -> Dict[str, Tensor]:
+    """Load state dict from the checkpoint
+
+    The pooling layer of the pretrained encoder is not created anymore, so its
+    parameters stored in the old checkpoints are dropped
+
+    :param filepath: Filepath of the checkpoint
+    :return: State dict
+    """
+    # Memory-map the checkpoint instead of reading it at once if it is supported (torch>=2.1)
+    if "mmap" in inspect.signature(torch.load).parameters:
+        state_dict = torch.load(filepath, map_location="cpu", weights_only=True, mmap=True)
+    else:
+        state_dict = torch.load(filepath, map_location="cpu")
+    return {k: v for k, v in state_dict.items() if ".pooler." not in k}
+
+
+def compile_encoder(model: SentenceSimilarityModel):
+    """Compile the pretrained encoder with torch.compile (requires torch>=2.0)
+
+    Only the forward is replaced, so the state dict keys are kept as is
+
+    :param model: Similarity model whose encoder will be compiled
+    """
+    if not hasattr(torch, "compile"):
+        raise ValueError(f"torch.compile is not supported on {torch.__version__ = }")
+    encoder = model.representation_model.model
+    encoder.forward = torch.compile(encoder.forward, dynamic=True)
+
+
 def create_contrastive_learning(
-    model_name: str, temp: float = 1.0, dense_rwmd: bool = False
+    model_name: str,
+    temp: float = 1.0,
+    dense_rwmd: bool = False,
+    gradient_checkpointing: bool = False,
 ) -> nn.Module:
-    model = create_similarity_model(model_name)
+    model = create_similarity_model(model_name, gradient_checkpointing)
     if model_name.endswith("cls"):
         return SimcseLearningModule(model, PairwiseCosineSimilarity(), temp)
     elif model_name.endswith("avg"):
@@ -29,3 +29,17 @@ def masked_mean(x: Tensor, mask: Tensor, dim: int) -> Tensor:
     :return: Result of mean
     """
     return masked_sum(x, mask, dim) / torch.count_nonzero(mask, dim=dim)
+
+
+def masked_average_pool(x: Tensor, mask: Tensor) -> Tensor:
+    """Average pooling over the sequence (masked version)
+
+    Unlike `masked_mean`, `x` should not contain inf, so that the masked sum
+    could be computed as a single reduction
+
+    :param x: Input (batch, seq_len, hidden)
+    :param mask: Mask (batch, seq_len)
+    :return: Result of average pooling (batch, hidden)
+    """
+    mask = mask.to(x.dtype)
+    return torch.einsum("blh,bl->bh", x, mask) / mask.sum(dim=1, keepdim=True)
@@ -1,12 +1,18 @@
-from functools import partial
+import os
+import shutil
+import tempfile
+from pathlib import Path
 
 import pytest
-from transformers import AutoTokenizer
+import torch
 
-from clrcmd.data.dataset import NLIContrastiveLearningDataset
+from clrcmd.data.dataset import (
+    ContrastiveLearningCollator,
+    NLIContrastiveLearningDataset,
+)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def corpus_nli():
     return [
         "sent0,sent1,hard_neg",
@@ -16,30 +22,80 @@ def corpus_nli():
     ]
 
 
-@pytest.fixture
-def filepath_nli(tmpdir, corpus_nli):
-    tmpfile = tmpdir.join("nli.csv")
-    tmpfile.write("\n".join(corpus_nli))
-    return tmpfile.strpath
-
-
-@pytest.fixture
-def tokenizer():
-    return AutoTokenizer.from_pretrained("roberta-base", use_fast=False)
-
-
-def test_nli_dataset(filepath_nli, tokenizer, corpus_nli):
-    dataset = NLIContrastiveLearningDataset(filepath_nli, tokenizer)
-    tokenize_fn = partial(
-        tokenizer.__call__,
-        padding="max_length",
-        max_length=32,
-        truncation=True,
-    )
-    for i in range(len(dataset)):
-        raw = corpus_nli[i + 1]
-        example = dataset[i]
-        x, pos, neg = raw.split(",")
-        assert {k: v.tolist() for k, v in example["inputs1"].items()} == tokenize_fn(x)
-        assert {k: v.tolist() for k, v in example["inputs2"].items()} == tokenize_fn(pos)
-        assert {k: v.tolist() for k, v in example["inputs_neg"].items()} == tokenize_fn(neg)
+@pytest.fixture(scope="session")
+def filepath_nli(tmp_path_factory, corpus_nli):
+    # Keep the corpus on tmpfs (memory) if it is available
+    if os.path.isdir("/dev/shm"):
+        dirpath = Path(tempfile.mkdtemp(dir="/dev/shm"))
+    else:
+        dirpath = tmp_path_factory.mktemp("nli")
+    filepath = dirpath / "nli.csv"
+    filepath.write_bytes(b"\n".join(x.encode() for x in corpus_nli))
+    yield str(filepath)
+    shutil.rmtree(dirpath)
+
+
+@pytest.fixture(scope="session")
+def truths_nli(tokenizer, corpus_nli):
+    x, pos, neg = zip(*(row.split(",") for row in corpus_nli[1:]))
+    return {
+        k: tokenizer(
+            list(v), padding="max_length", max_length=32, truncation=True, return_tensors="pt"
+        )
+        for k, v in (("inputs1", x), ("inputs2", pos), ("inputs_neg", neg))
+    }
+
+
+@pytest.fixture(scope="session")
+def dataset_nli(filepath_nli, tokenizer):
+    return NLIContrastiveLearningDataset(filepath_nli, tokenizer)
+
+
+@pytest.mark.parametrize("idx", [0, 1, 2])
+def test_nli_dataset(idx, dataset_nli, truths_nli):
+    assert len(dataset_nli) == 3
+    assert all(v.element_size() < 8 for x in dataset_nli.examples.values() for v in x.values())
+    example = dataset_nli[idx]
+    for k, truth in truths_nli.items():
+        assert example[k].keys() == truth.keys()
+        assert all(torch.equal(v, truth[name][idx]) for name, v in example[k].items())
+
+
+def test_nli_dataset_cache(tmp_path, monkeypatch, filepath_nli, tokenizer, dataset_nli):
+    filepath = tmp_path / "nli.csv"
+    filepath.write_bytes(Path(filepath_nli).read_bytes())
+    os.utime(filepath, ns=(0, 0))
+    NLIContrastiveLearningDataset(str(filepath), tokenizer, cache_dir=str(tmp_path))
+    # Cache of the previous version of the file should be replaced
+    os.utime(filepath, ns=(10**9, 10**9))
+    NLIContrastiveLearningDataset(str(filepath), tokenizer, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.glob("*.pt"))) == 1
+
+    # The second dataset should be loaded from the cache without tokenization
+    def tokenize(self, filepath):
+        raise AssertionError("Dataset is tokenized again")
+
+    monkeypatch.setattr(NLIContrastiveLearningDataset, "tokenize", tokenize)
+    dataset = NLIContrastiveLearningDataset(str(filepath), tokenizer, cache_dir=str(tmp_path))
+    assert len(dataset) == len(dataset_nli)
+    for idx in range(len(dataset)):
+        example, truth = dataset[idx], dataset_nli[idx]
+        for k in truth:
+            assert all(torch.equal(v, truth[k][name]) for name, v in example[k].items())
+
+
+def test_contrastive_learning_collator():
+    def create_feature(input_ids, label):
+        input_ids = torch.tensor(input_ids)
+        return {
+            "inputs1": {"input_ids": input_ids, "attention_mask": (input_ids > 0).long()},
+            "inputs2": {"input_ids": input_ids, "attention_mask": (input_ids > 0).long()},
+            "label": torch.tensor(label),
+        }
+
+    features = [create_feature([5, 6, 0, 0, 0], 1.0), create_feature([5, 6, 7, 0, 0], 2.0)]
+    batch = ContrastiveLearningCollator()(features)
+    for k in ("inputs1", "inputs2"):
+        assert batch[k]["input_ids"].tolist() == [[5, 6, 0], [5, 6, 7]]
+        assert batch[k]["attention_mask"].tolist() == [[1, 1, 0], [1, 1, 1]]
+    assert batch["label"].tolist() == [1.0, 2.0]
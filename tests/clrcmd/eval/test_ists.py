@@ -1,6 +1,76 @@
+import numpy as np
 import pytest
+import torch
 
-from clrcmd.eval.ists import load_instances
+from clrcmd.evaluation.ists import load_examples, pool_heatmap, preprocess
+
+TRUE_EXAMPLES = [
+    {
+        "id": 1,
+        "sent1": "both bulbs a and c still have a closed path",
+        "sent2": "Bulbs A and C are still in closed paths",
+        "sent1_chunk": ["both", "bulbs a and c", "still", "have", "a closed path"],
+        "sent2_chunk": ["Bulbs A and C", "are", "still", "in closed paths"],
+    },
+    {
+        "id": 2,
+        "sent1": "terminal 1 and the positive terminal are connected.",
+        "sent2": "Terminal 1 and the positive terminal are separated by the gap",
+        "sent1_chunk": ["terminal 1 and the positive terminal", "are connected."],
+        "sent2_chunk": [
+            "Terminal 1 and the positive terminal",
+            "are separated",
+            "by the gap",
+        ],
+    },
+    {
+        "id": 3,
+        "sent1": "positive battery is seperated by a gap from terminal 2",
+        "sent2": "Terminal 2 and the positive terminal are separated by the gap",
+        "sent1_chunk": [
+            "positive battery",
+            "is seperated",
+            "by a gap",
+            "from terminal 2",
+        ],
+        "sent2_chunk": [
+            "Terminal 2 and the positive terminal",
+            "are separated",
+            "by the gap",
+        ],
+    },
+    {
+        "id": 4,
+        "sent1": "There is no difference between the two terminals.",
+        "sent2": "The terminals are in the same state.",
+        "sent1_chunk": [
+            "There",
+            "is",
+            "no difference",
+            "between the two terminals.",
+        ],
+        "sent2_chunk": ["The terminals", "are", "in the same state."],
+    },
+    {
+        "id": 5,
+        "sent1": (
+            "the switch has to be contained in the same path as the bulb and the" " battery"
+        ),
+        "sent2": "The switch and the bulb have to be in the same path.",
+        "sent1_chunk": [
+            "the switch",
+            "has to be contained",
+            "in the same path",
+            "as",
+            "the bulb and the battery",
+        ],
+        "sent2_chunk": [
+            "The switch and the bulb",
+            "have to be",
+            "in the same path.",
+        ],
+    },
+]
 
 
 @pytest.fixture
@@ -55,77 +125,50 @@ def filepath_sent2_chunk(tmpdir):
     return tmpfile.strpath
 
 
-def test_load_instances(
+def test_load_examples(
     filepath_sent1, filepath_sent2, filepath_sent1_chunk, filepath_sent2_chunk
 ):
-    pred = load_instances(
+    pred = load_examples(
         filepath_sent1, filepath_sent2, filepath_sent1_chunk, filepath_sent2_chunk
     )
-    true = [
-        {
-            "id": 1,
-            "sent1": "both bulbs a and c still have a closed path",
-            "sent2": "Bulbs A and C are still in closed paths",
-            "sent1_chunk": ["both", "bulbs a and c", "still", "have", "a closed path"],
-            "sent2_chunk": ["Bulbs A and C", "are", "still", "in closed paths"],
-        },
-        {
-            "id": 2,
-            "sent1": "terminal 1 and the positive terminal are connected.",
-            "sent2": "Terminal 1 and the positive terminal are separated by the gap",
-            "sent1_chunk": ["terminal 1 and the positive terminal", "are connected."],
-            "sent2_chunk": [
-                "Terminal 1 and the positive terminal",
-                "are separated",
-                "by the gap",
-            ],
-        },
-        {
-            "id": 3,
-            "sent1": "positive battery is seperated by a gap from terminal 2",
-            "sent2": "Terminal 2 and the positive terminal are separated by the gap",
-            "sent1_chunk": [
-                "positive battery",
-                "is seperated",
-                "by a gap",
-                "from terminal 2",
-            ],
-            "sent2_chunk": [
-                "Terminal 2 and the positive terminal",
-                "are separated",
-                "by the gap",
-            ],
-        },
-        {
-            "id": 4,
-            "sent1": "There is no difference between the two terminals.",
-            "sent2": "The terminals are in the same state.",
-            "sent1_chunk": [
-                "There",
-                "is",
-                "no difference",
-                "between the two terminals.",
-            ],
-            "sent2_chunk": ["The terminals", "are", "in the same state."],
-        },
-        {
-            "id": 5,
-            "sent1": (
-                "the switch has to be contained in the same path as the bulb and the" " battery"
-            ),
-            "sent2": "The switch and the bulb have to be in the same path.",
-            "sent1_chunk": [
-                "the switch",
-                "has to be contained",
-                "in the same path",
-                "as",
-                "the bulb and the battery",
-            ],
-            "sent2_chunk": [
-                "The switch and the bulb",
-                "have to be",
-                "in the same path.",
-            ],
-        },
-    ]
-    assert pred == true
+    assert pred == TRUE_EXAMPLES
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize(
+    "sent1_chunk2token,sent2_chunk2token",
+    [
+        ([[0, 1], [2], [3, 4, 5]], [[0], [1, 2, 3], [4, 5, 6]]),
+        ([[0, 1, 2, 3, 4, 5]], [[0, 1], [2, 3], [4], [5, 6]]),
+        ([[0, 1], [], [2, 3, 4, 5]], [[0], [1, 2, 3], [4, 5, 6]]),  # Empty chunk
+    ],
+)
+def test_pool_heatmap(sent1_chunk2token, sent2_chunk2token):
+    heatmap = np.random.default_rng(0).random((6, 7), dtype=np.float32)
+
+    # Compute pooled heatmap using implemented function
+    out = pool_heatmap(heatmap, (None, sent1_chunk2token), (None, sent2_chunk2token))
+
+    # Naively average heatmap blockwise
+    true1 = np.zeros((len(sent1_chunk2token), len(sent2_chunk2token)))
+    true2 = np.zeros((len(sent1_chunk2token), len(sent2_chunk2token)))
+    for i, x in enumerate(sent1_chunk2token):
+        for j, y in enumerate(sent2_chunk2token):
+            true1[i, j] = np.mean(np.mean(heatmap[np.ix_(x, y)], axis=1))
+            true2[i, j] = np.mean(np.mean(heatmap[np.ix_(x, y)], axis=0))
+    np.testing.assert_allclose(out, (true1 + true2) / 2, rtol=1e-6)
+
+
+def test_preprocess(tokenizer):
+    prep_examples = preprocess(tokenizer, TRUE_EXAMPLES)
+    assert len(prep_examples) == len(TRUE_EXAMPLES)
+    for prep_example, example in zip(prep_examples, TRUE_EXAMPLES):
+        assert prep_example["example"] == example
+        for k in ("sent1", "sent2"):
+            # Compare with tokenizing each sentence separately
+            input_ids = tokenizer(example[k], add_special_tokens=False)["input_ids"]
+            assert prep_example[f"{k}_token"] == tokenizer.convert_ids_to_tokens(input_ids)
+            truth = tokenizer(example[k], return_tensors="pt")
+            inputs = prep_example[k.replace("sent", "inputs")]
+            assert inputs.keys() == truth.keys()
+            assert all(torch.equal(v, truth[name]) for name, v in inputs.items())
@@ -1,22 +1,28 @@
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 
 from clrcmd.models import (
+    CachedSentenceRepresentationModel,
     DensePairwiseRelaxedWordMoverSimilarity,
+    PairwiseCosineSimilarity,
     PairwiseRelaxedWordMoverSimilarity,
     RelaxedWordMoverSimilarity,
 )
 
 
-def test_pairwise_relaxed_word_mover_similarity():
-    torch.manual_seed(0)
+def test_pairwise_relaxed_word_mover_similarity(generator):
     model = PairwiseRelaxedWordMoverSimilarity()
 
     # Create random input
-    x1 = torch.rand((9, 6, 10))
-    mask1 = torch.bernoulli(torch.full((x1.shape[0], x1.shape[1]), 0.6)).bool()
-    x2 = torch.rand((10, 8, 10))
-    mask2 = torch.bernoulli(torch.full((x2.shape[0], x2.shape[1]), 0.6)).bool()
+    x1 = torch.rand((9, 6, 10), generator=generator)
+    mask1 = torch.bernoulli(
+        torch.full((x1.shape[0], x1.shape[1]), 0.6), generator=generator
+    ).bool()
+    x2 = torch.rand((10, 8, 10), generator=generator)
+    mask2 = torch.bernoulli(
+        torch.full((x2.shape[0], x2.shape[1]), 0.6), generator=generator
+    ).bool()
 
     # Compute similarity using implemented module
     out = model((x1, mask1), (x2, mask2))
@@ -39,15 +45,18 @@ def test_pairwise_relaxed_word_mover_similarity():
     assert torch.all(torch.isclose(out, sim))
 
 
-def test_dense_pairwise_relaxed_word_mover_similarity():
-    torch.manual_seed(0)
+def test_dense_pairwise_relaxed_word_mover_similarity(generator):
     model = DensePairwiseRelaxedWordMoverSimilarity()
 
     # Create random input
-    x1 = torch.rand((9, 6, 10))
-    mask1 = torch.bernoulli(torch.full((x1.shape[0], x1.shape[1]), 0.6)).bool()
-    x2 = torch.rand((10, 8, 10))
-    mask2 = torch.bernoulli(torch.full((x2.shape[0], x2.shape[1]), 0.6)).bool()
+    x1 = torch.rand((9, 6, 10), generator=generator)
+    mask1 = torch.bernoulli(
+        torch.full((x1.shape[0], x1.shape[1]), 0.6), generator=generator
+    ).bool()
+    x2 = torch.rand((10, 8, 10), generator=generator)
+    mask2 = torch.bernoulli(
+        torch.full((x2.shape[0], x2.shape[1]), 0.6), generator=generator
+    ).bool()
 
     # Compute similarity using implemented module
     out = model((x1, mask1), (x2, mask2))
@@ -70,15 +79,18 @@ def test_dense_pairwise_relaxed_word_mover_similarity():
     assert torch.all(torch.isclose(out, sim))
 
 
-def test_relaxed_word_mover_similarity():
-    torch.manual_seed(0)
+def test_relaxed_word_mover_similarity(generator):
     model = RelaxedWordMoverSimilarity()
 
     # Create random input
-    x1 = torch.rand((2, 6, 10))
-    mask1 = torch.bernoulli(torch.full((x1.shape[0], x1.shape[1]), 0.6)).bool()
-    x2 = torch.rand((2, 8, 10))
-    mask2 = torch.bernoulli(torch.full((x2.shape[0], x2.shape[1]), 0.6)).bool()
+    x1 = torch.rand((2, 6, 10), generator=generator)
+    mask1 = torch.bernoulli(
+        torch.full((x1.shape[0], x1.shape[1]), 0.6), generator=generator
+    ).bool()
+    x2 = torch.rand((2, 8, 10), generator=generator)
+    mask2 = torch.bernoulli(
+        torch.full((x2.shape[0], x2.shape[1]), 0.6), generator=generator
+    ).bool()
 
     # Compute similarity using implemented module
     out = model((x1, mask1), (x2, mask2))
@@ -97,3 +109,64 @@ def test_relaxed_word_mover_similarity():
     sim2 = torch.sum(sim2, dim=-1) / torch.count_nonzero(mask2, dim=-1)
     sim = (sim1 + sim2) / 2
     assert torch.all(torch.isclose(out, sim))
+
+
+def test_pairwise_cosine_similarity(generator):
+    model = PairwiseCosineSimilarity()
+
+    # Create random input
+    x1 = torch.rand((9, 10), generator=generator)
+    x2 = torch.rand((7, 10), generator=generator)
+
+    # Compute similarity using implemented module
+    out = model(x1, x2)
+
+    # Naively compute similarity
+    sim = F.cosine_similarity(x1[:, None, :], x2[None, :, :], dim=-1)
+    assert out.shape == (9, 7)
+    assert torch.all(torch.isclose(out, sim))
+
+    # Similarity should be computed in float32 under autocast
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        out = model(x1, x2)
+    assert out.dtype == torch.float32
+    assert torch.all(torch.isclose(out, sim))
+
+
+class EmbeddingSentenceRepresentationModel(nn.Module):
+    def __init__(self, pooling: bool):
+        super().__init__()
+        self.embedding = nn.Embedding(20, 10)
+        self.pooling = pooling
+
+    def forward(self, inputs):
+        mask = inputs["attention_mask"].bool()
+        outputs = self.embedding(inputs["input_ids"])
+        if self.pooling:
+            return outputs[:, 0]
+        return outputs, mask
+
+
+def test_cached_sentence_representation_model():
+    inputs = {
+        "input_ids": torch.tensor([[1, 2, 3, 0], [4, 5, 0, 0], [1, 2, 3, 0]]),
+        "attention_mask": torch.tensor([[1, 1, 1, 0], [1, 1, 0, 0], [1, 1, 1, 0]]),
+    }
+    inputs_trimmed = {k: v[:, :3] for k, v in inputs.items()}
+
+    # Sentence embedding
+    model = EmbeddingSentenceRepresentationModel(pooling=True)
+    cached_model = CachedSentenceRepresentationModel(model, max_size=2)
+    assert torch.equal(cached_model(inputs), model(inputs))
+    assert torch.equal(cached_model(inputs_trimmed), model(inputs_trimmed))
+    assert len(cached_model.cache) == 2
+    # Cached rows should not be views of the batch output
+    assert all(x._base is None for x in cached_model.cache.values())
+
+    # Token embedding
+    model = EmbeddingSentenceRepresentationModel(pooling=False)
+    cached_model = CachedSentenceRepresentationModel(model)
+    for x in (inputs, inputs_trimmed):
+        (out, out_mask), (true, true_mask) = cached_model(x), model(x)
+        assert torch.equal(out_mask, true_mask)
+        assert torch.equal(out[out_mask], true[true_mask])
@@ -0,0 +1,16 @@
+import torch
+
+from clrcmd.utils import masked_average_pool, masked_mean
+
+
+def test_masked_average_pool(generator):
+    # Create random input
+    x = torch.rand((4, 6, 10), generator=generator)
+    mask = torch.bernoulli(torch.full((x.shape[0], x.shape[1]), 0.6), generator=generator).bool()
+    mask[:, 0] = True
+
+    # Compute average pooling using implemented function
+    out = masked_average_pool(x, mask)
+
+    # Compare with masked mean
+    assert torch.all(torch.isclose(out, masked_mean(x, mask.unsqueeze(2), dim=1)))
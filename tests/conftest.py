@@ -0,0 +1,17 @@
+import pytest
+import torch
+from filelock import FileLock
+from transformers import AutoTokenizer
+
+
+@pytest.fixture
+def generator():
+    return torch.Generator().manual_seed(0)
+
+
+@pytest.fixture(scope="session")
+def tokenizer(tmp_path_factory):
+    # Let a single pytest-xdist worker populate the cache while the others wait on it
+    lock = tmp_path_factory.getbasetemp().parent / "tokenizer.lock"
+    with FileLock(str(lock)):
+        return AutoTokenizer.from_pretrained("roberta-base")